@@ -1,33 +1,54 @@
+import time
+_starttime = time.perf_counter()  # reference point of --profile-startup
 
 import base64
 import configparser
 import datetime
+import functools
 import getpass
-import time
+import heapq
+import importlib
+import math
+import sys
 from collections import namedtuple
-import lxml.etree
 import logging
 import os
-import requests
-import rsa
-from tenacity import retry, stop_after_attempt, wait_fixed
+import queue
+import re
+import threading
 import urllib.parse
 
-import smtplib
+# lxml, requests, rsa, tenacity and smtplib are imported on first use (see lazyimport), so that the first request
+# can be sent as soon as possible after a restart
+smtp = None
+
+
+def lazyimport(name):  # import a module on first use and record its cost for --profile-startup
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        importtimes.append((name, time.perf_counter() - start))
+    return module
+
+
+def lazyretry(func):  # retry a request like tenacity's @retry, but only import tenacity when it is first called
+    retried = None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal retried
+        if retried is None:
+            tenacity = lazyimport("tenacity")
+            retried = tenacity.retry(stop=tenacity.stop_after_attempt(10), wait=tenacity.wait_fixed(0.25))(func)
+        return retried(*args, **kwargs)
 
-# 创建 SMTP 对象
-smtp = smtplib.SMTP()
-# 连接（connect）指定服务器
-smtp.connect("smtp.163.com", port=25)
-# 登录，需要：登录邮箱和授权码
-#todo:替换邮箱用户名和授权码
-smtp.login(user="", password="")
-from email.mime.text import MIMEText
-from email.header import Header
+    return wrapper
 
 
 def connectsmtp():
     global smtp
+    smtplib = lazyimport("smtplib")
     smtp = smtplib.SMTP()
     #todo:可能要改，根据不同的邮箱更改为不同的服务器
     smtp.connect("smtp.163.com", port=25)
@@ -37,16 +58,23 @@ def connectsmtp():
 
 def printf(mess, end="\n"):
     print(mess, end)
-    send(mess)
+    if reportq is not None:  # the pipeline is running, let the reporter send it
+        reportq.put(mess)
+    else:
+        send(mess)
 
 
 def send(messagetext):
     print(messagetext)
+    from email.mime.text import MIMEText
+    from email.header import Header
     message = MIMEText(messagetext, 'plain', 'utf-8')
     message['Subject'] = Header(messagetext, 'utf-8')  # 定义主题内容
     c = 1
     while c == 1:
         try:
+            if smtp is None:  # connect on the first notification instead of at import
+                connectsmtp()
             #todo:替换发件人和收件人
             smtp.sendmail(from_addr="", to_addrs="", msg=message.as_string())
             c = 2
@@ -100,12 +128,21 @@ def reconnect():
 VER = "1.3.3"
 query_delay = 1.5
 chk_select_time_delay = 5
+max_dispatch_delay = 0.01  # sec, a longer delay between dropping and selecting in a replacement is warned
 auto_cls = True
 warn_diff_campus = True
 CONFIGPATH = "courses.txt"
 keep_logs = True
 logging_level = 20
 LOGPATH = "selection.log"
+CATALOGPATH = "catalog.db"
+HISTORYPATH = "history.db"
+history_keep_raw = 86400  # observations older than this (sec) are downsampled
+history_bucket = 60  # seconds per downsampled observation
+history_flush = 10  # seconds between writes of the history store during selection
+release_window = 900  # seconds around a time of day in which past releases predict a release
+PROFILEPATH = "profile"  # --profile writes profile.folded (flame graph stacks) and profile.txt (per function summary)
+catalog_pagesize = 50
 LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
@@ -117,12 +154,53 @@ username = ""
 password = ""
 encryptedpassword = ""
 sterm = 0
+profile_startup = False
+importtimes = []  # (module, seconds) of modules imported by lazyimport
+startupphases = []  # (phase, seconds) recorded by markphase
+_phasetime = _starttime
+_pubkey = None
+selectedlist = []  # courses in the current timetable
+sectiontimes = {}  # (courseid, teacherid) -> time text of target sections
+replacementgaps = []  # Replacementgap of every replacement
+conflictmap = {}  # (courseid, teacherid) -> selected courses certainly conflicting with the section
+rejectedsections = set()  # (courseid, teacherid) of sections the server rejected with 课时冲突, kept across timetables
+
+# Pipeline: poller -> decideq -> decision engine -> submitq -> submitter, messages of all stages -> reportq -> reporter
+decideq = None  # (item, sections) observed by the poller
+submitq = None  # items with an open section chosen by the decision engine
+reportq = None  # messages to send, None when the pipeline is not running
+stopevent = None
+targetstates = {}  # targetkey -> "polling", "submitting" or "done"
+pipelineerrors = []
+listlock = threading.RLock()  # held by the stages that change inputlist
+sessionlock = threading.RLock()  # held while selecting term or copying the login cookies to the poller's session
+
+historybuffer = []  # observations not yet written to the history store
+releasebuffer = []  # seat releases not yet written to the history store
+lastnumbers = {}  # (courseid, teacherid) -> number and time of the last observation
+releasetimes = {}  # (courseid, teacherid) -> seconds of day of past seat releases
+nextpolls = {}  # targetkey -> time of the next poll
+
+profilestacks = {}  # folded stack -> number of samples taken by the sampling profiler
+profilelock = threading.Lock()
+profilerstop = None
 
 # Declaration
 Termitem = namedtuple("Term", ["termid", "name"])
 Courseinfo = namedtuple("CourseInfo",
-                        ["courseid", "coursename", "teacherid", "teachername", "capacity", "number", "restriction"])
-Courseitem = namedtuple("CourseItem", ["courseid", "teacherid", "replacecid", "replacetid"])
+                        ["courseid", "coursename", "teacherid", "teachername", "capacity", "number", "restriction",
+                         "credit", "timetext"], defaults=("", ""))
+Courseitem = namedtuple("CourseItem", ["courseid", "teacherid", "replacecid", "replacetid", "group"], defaults=((),))
+# group: teacher ids of acceptable sections of the course in order of priority, empty if only teacherid is acceptable
+Selectedcourse = namedtuple("SelectedCourse", ["courseid", "coursename", "teacherid", "teachername", "timetext"])
+Replacementgap = namedtuple("ReplacementGap", ["droprtt", "dispatch", "exposed"])
+# dispatch: local delay between the drop response and sending the select request
+# exposed: time from the drop response to the select response, for which the dropped seats are open to others
+Strategy = namedtuple("Strategy", ["name", "query_delay", "group", "batched", "fullcheck"])
+Simscenario = namedtuple("SimScenario", ["sections", "capacity", "window", "release_rate", "competitors", "reaction",
+                                         "latency", "error_rate"],
+                         defaults=(3, 30, 300, 0.5, 20, 30, 0.08, 0.02))
+# release_rate: seats released per minute per section; reaction: mean reaction time (sec) of a competitor
 Selectionresult = namedtuple("SelectionResult",
                              ["courseid", "coursename", "teacherid", "teachername", "msg", "isSuccess"])
 
@@ -138,6 +216,10 @@ _selectedcourse = "CourseSelectionStudent/QueryCourseTable"
 _dropcourse = "CourseReturnStudent/CourseReturnSave"
 _baseerror = "Base/Error"
 
+_timeslot = re.compile(r"([一二三四五六日七])(\d+)(?:-(\d+))?(\s*[(（][^)）]*[)）])?")
+
+_formheaders = {'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8'}
+
 _stop_condition = ["课时冲突", "已选同组课程", "已选过且成绩合格"]
 _stop_condition2 = ["已选此课程", "课时冲突", "已选同组课程", "已选过且成绩合格"]
 
@@ -161,6 +243,30 @@ def printnwarn(msg):
     printf(msg)
     logging.warning(msg)
 
+def markphase(name):  # record the time spent since the previous phase for --profile-startup
+    global _phasetime
+    now = time.perf_counter()
+    startupphases.append((name, now - _phasetime))
+    _phasetime = now
+
+
+def reportstartup():  # print and log the startup profile, then stop profiling
+    global profile_startup
+    print("-------------------------")
+    print("Startup profile:")
+    for name, cost in startupphases:
+        print("  %-28s %9.1f ms" % (name, cost * 1000))
+        logging.info("Startup phase %s: %.1f ms" % (name, cost * 1000))
+    for name, cost in importtimes:
+        print("  %-28s %9.1f ms" % ("(import %s)" % name, cost * 1000))
+        logging.info("Startup import %s: %.1f ms" % (name, cost * 1000))
+    total = _phasetime - _starttime
+    print("  %-28s %9.1f ms" % ("Total", total * 1000))
+    logging.info("Startup total: %.1f ms" % (total * 1000))
+    print("-------------------------", end="\n\n")
+    profile_startup = False
+
+
 def initconfig():  # write a default config
     config = configparser.ConfigParser(allow_no_value=True)
     config["Userinfo"] = {}
@@ -243,13 +349,14 @@ def readconfig():  # read config from file
         s = courses.get("course%d" % i, "")
         if s != "":
             a = s.split(",")
-            if len(a) != 2 or len(a[0]) != 8 or len(a[1]) != 4:
-                if len(a) != 4 or len(a[2]) != 8 or len(a[3]) != 4:
-                    print(s + " is not a valid course format")
-                    continue
+            tids = a[1].split("/") if len(a) > 1 else []
+            if len(a) not in (2, 4) or len(a[0]) != 8 or not all(len(x) == 4 for x in tids) \
+                    or (len(a) == 4 and (len(a[2]) != 8 or len(a[3]) != 4)):
+                print(s + " is not a valid course format")
+                continue
             if len(a) == 2:
-                s = s + ",null,null"
-            inputlist.append(Courseitem._make(s.split(",")))
+                a += ["null", "null"]
+            inputlist.append(Courseitem(a[0], tids[0], a[2], a[3], tuple(tids) if len(tids) > 1 else ()))
         else:
             break
     print("OK")
@@ -288,14 +395,22 @@ def clear():  # cross-platform clear screen function
         _ = os.system('clear')
 
 
+def getpubkey():  # parse the SSO public key only once
+    global _pubkey
+    if _pubkey is None:
+        _pubkey = lazyimport("rsa").PublicKey.load_pkcs1_openssl_pem(_keystr.encode('utf-8'))
+    return _pubkey
+
+
 def encryptPass(passwd):
-    pubkey = rsa.PublicKey.load_pkcs1_openssl_pem(_keystr.encode('utf-8'))
+    rsa = lazyimport("rsa")
+    pubkey = getpubkey()
     encryptpwd = base64.b64encode(rsa.encrypt(passwd.encode('utf-8'), pubkey)).decode()
     return encryptpwd
 
 
 def getTerms(text):  # analyze terms from text
-    html = lxml.etree.HTML(text)
+    html = lazyimport("lxml.etree").HTML(text)
     termslist = html.xpath("//table/tr[@name='rowterm']")
     terms = []
     for term in termslist:
@@ -307,7 +422,7 @@ def getTerms(text):  # analyze terms from text
 
 def deletecoursefromlist(cid, tid):  # delete an item from list
     global inputlist
-    index = findcourseinlist(cid, tid, inputlist)
+    index = findtargetinlist(cid, tid)
     if index != -1:
         del inputlist[index]
         logging.info("Delete course %s,%s from list" % (cid, tid))
@@ -323,6 +438,13 @@ def findcourseinlist(cid, tid, listitem):  # find the item in a list given cid a
     return -1
 
 
+def findtargetinlist(cid, tid):  # find the item in the inputlist given cid and tid of any section in its group
+    for index, item in enumerate(inputlist):
+        if (item.courseid == cid) and (item.teacherid == tid or tid in item.group):
+            return index
+    return -1
+
+
 def findreplaceinlist(cid, tid):  # find the item in the inputlist given replacecid and replacetid
     for index, item in enumerate(inputlist):
         if (item.replacecid == cid) and (item.replacetid == tid):
@@ -330,11 +452,10 @@ def findreplaceinlist(cid, tid):  # find the item in the inputlist given replace
     return -1
 
 
-@retry(stop=stop_after_attempt(10), wait=wait_fixed(0.25))
-def getCourseInfo(cid, tid, sess: requests.session):  # query course info by cid and tid
-    params = {
-        "PageIndex": 1,
-        "PageSize": 1,
+def queryparams(pageindex=1, pagesize=1, cid="", tid="", campus="", college="", timetext=""):  # form of QueryCourseList
+    return {
+        "PageIndex": pageindex,
+        "PageSize": pagesize,
         "FunctionString": "Query",
         "CID": cid,
         "CourseName": "",
@@ -345,17 +466,34 @@ def getCourseInfo(cid, tid, sess: requests.session):  # query course info by cid
         "Enrolls": "",
         "Capacity1": "",
         "Capacity2": "",
-        "CampusId": "",
-        "CollegeId": "",
+        "CampusId": campus,
+        "CollegeId": college,
         "Credit": "",
-        "TimeText": ""
+        "TimeText": timetext
     }
+
+
+def parsecourserow(td):  # analyze a row of QueryCourseList given its cells
+    return Courseinfo(courseid=td[0].text.strip(),
+                      coursename=td[1].text.strip(),
+                      teacherid=td[3].text.strip(),
+                      teachername=td[4].xpath("./span/text()")[0],
+                      capacity=int(td[8].text.strip()),
+                      number=int(td[9].text.strip()),
+                      restriction=td[11].text.strip() if td[11].text else "",
+                      credit=td[2].text.strip() if td[2].text else "",
+                      timetext=td[5].text.strip() if td[5].text else "")
+
+
+@lazyretry
+def getCourseInfo(cid, tid, sess):  # query course info by cid and tid
+    params = queryparams(cid=cid, tid=tid)
     count = 0
     while count < 5:
         try:
             r = sess.post(_baseurl + _querycourse, params, timeout=5)
             break
-        except requests.exceptions.Timeout:
+        except lazyimport("requests").exceptions.Timeout:
             reconnect()
             if count == 4:
                 printf("网络重新连接失败了")
@@ -363,7 +501,7 @@ def getCourseInfo(cid, tid, sess: requests.session):  # query course info by cid
 
     if "未查询到符合条件的数据！" in r.text:
         raise RuntimeError(3, f"Course Not Exist")
-    html = lxml.etree.HTML(r.text)
+    html = lazyimport("lxml.etree").HTML(r.text)
     a = 1
     starttime = time.time()
     while a == 1:
@@ -377,15 +515,9 @@ def getCourseInfo(cid, tid, sess: requests.session):  # query course info by cid
             if (endtime - starttime >= 30):
                 printf("网络炸了")
                 time.sleep(20)
-            html = lxml.etree.HTML(r.text)
+            html = lazyimport("lxml.etree").HTML(r.text)
     try:
-        return Courseinfo(courseid=td[0].text.strip(),
-                          coursename=td[1].text.strip(),
-                          teacherid=td[3].text.strip(),
-                          teachername=td[4].xpath("./span/text()")[0],
-                          capacity=int(td[8].text.strip()),
-                          number=int(td[9].text.strip()),
-                          restriction=td[11].text.strip() if td[11].text else "")
+        return parsecourserow(td)
     except:
         emsg = r.status_code
         if r.url.startswith(_baseurl+_baseerror):
@@ -402,6 +534,29 @@ def getCourseInfo(cid, tid, sess: requests.session):  # query course info by cid
                           restriction="Error Occurred: %s Retry..." % emsg)
 
 
+def getCourseSections(cid, sess):  # query all sections of a course in one request
+    # no retries: a failed poll must not stall the poller, the next poll is the retry
+    return querycoursepage(1, sess, 5, cid=cid)
+
+
+def choosesection(item, sections):  # choose the best open section of a group, None if none can be selected
+    candidates = []
+    for tid in item.group:
+        if item.courseid == item.replacecid and tid == item.replacetid:
+            continue  # the section to be replaced is not an alternative
+        for course in sections:
+            if course.teacherid == tid and canSelect(course) and not isconflicting(item.courseid, tid):
+                candidates.append(course)
+    for course in candidates:  # prefer the sections with vacancies, in order of priority
+        if course.number < course.capacity:
+            return course
+    return candidates[0] if candidates else None
+
+
+def str_group(item):
+    return "%s by %s" % (item.courseid, "/".join(item.group))
+
+
 def canSelect(cinfo):  # judge whether a course can be selected
     if cinfo.restriction:
         return False
@@ -413,7 +568,360 @@ def canSelect(cinfo):  # judge whether a course can be selected
     return True
 
 
-@retry(stop=stop_after_attempt(10), wait=wait_fixed(0.25))
+def isfinal(selection):  # judge whether a target is finished given its selection result: success or need user actions
+    return selection.isSuccess or any(x in selection.msg for x in _stop_condition2)
+
+
+@lazyretry
+def synccoursepage(pageindex, sess, **filters):  # retrying page query for --sync-catalog; polling uses querycoursepage directly
+    return querycoursepage(pageindex, sess, 10, **filters)
+
+
+def querycoursepage(pageindex, sess, timeout, **filters):  # query a page of QueryCourseList, filters are those of queryparams
+    params = queryparams(pageindex=pageindex, pagesize=catalog_pagesize, **filters)
+    r = sess.post(_baseurl + _querycourse, params, timeout=timeout)
+    if "未查询到符合条件的数据！" in r.text:
+        return []
+    if r.url.startswith(_baseurl + _baseerror):
+        emsg = urllib.parse.unquote(r.url.replace(_baseurl + _baseerror + "?msg=", ""))
+        logging.warning("Query course page %d failed: %s" % (pageindex, emsg))
+        raise RuntimeError("Query course page failed: %s" % emsg)
+    html = lazyimport("lxml.etree").HTML(r.text)
+    result = []
+    for row in html.xpath("//table[@class='tbllist']/tr[td]"):
+        td = row.xpath("./td")
+        if len(td) < 12:
+            continue
+        result.append(parsecourserow(td))
+    return result
+
+
+def opencatalog():  # open the local course catalog, creating tables if needed
+    sqlite3 = lazyimport("sqlite3")
+    db = sqlite3.connect(CATALOGPATH)
+    columns = [x[1] for x in db.execute("PRAGMA table_info(courses)")]
+    if columns and "term" not in columns:  # catalog of an earlier version without terms, sync again
+        db.execute("DROP TABLE courses")
+        db.execute("DROP TABLE IF EXISTS syncs")
+    db.execute("""CREATE TABLE IF NOT EXISTS courses (
+                      term TEXT, courseid TEXT, teacherid TEXT, coursename TEXT, teachername TEXT, credit TEXT,
+                      timetext TEXT, capacity INTEGER, number INTEGER, restriction TEXT, updated REAL,
+                      PRIMARY KEY (term, courseid, teacherid))""")
+    db.execute("CREATE INDEX IF NOT EXISTS courses_name ON courses (coursename)")
+    db.execute("CREATE INDEX IF NOT EXISTS courses_teacher ON courses (teachername)")
+    db.execute("CREATE TABLE IF NOT EXISTS syncs (filters TEXT PRIMARY KEY, finished REAL, count INTEGER)")
+    return db
+
+
+def syncCatalog(sess, maxage=0, **filters):  # crawl QueryCourseList page by page into the catalog
+    db = opencatalog()
+    key = ",".join(["term=%s" % sterm] + ["%s=%s" % (k, v) for k, v in sorted(filters.items()) if v])
+    last = db.execute("SELECT finished FROM syncs WHERE filters = ?", (key,)).fetchone()
+    if maxage > 0 and last is not None and time.time() - last[0] < maxage * 60:
+        print("Catalog [%s] was synced %.1f min ago, skipped" % (key, (time.time() - last[0]) / 60))
+        db.close()
+        return 0
+    started = time.time()
+    pageindex = 1
+    count = 0
+    lastpage = None
+    while True:
+        courses = synccoursepage(pageindex, sess, **filters)
+        # a short page is not the end: rows may be skipped when parsing, or PageSize capped by the server
+        page = [(c.courseid, c.teacherid) for c in courses]
+        if not courses or page == lastpage:  # past the last page, some servers repeat it instead of returning none
+            break
+        lastpage = page
+        now = time.time()
+        db.executemany("INSERT OR REPLACE INTO courses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(sterm, c.courseid, c.teacherid, c.coursename, c.teachername, c.credit, c.timetext,
+                         c.capacity, c.number, c.restriction, now) for c in courses])
+        db.commit()
+        count += len(courses)
+        print("\rSyncing catalog [%s]: page %d, %d teaching class(es)" % (key, pageindex, count), end="")
+        pageindex += 1
+    print()
+    if not any(filters.values()):  # a full crawl has seen every class of the term, drop those no longer offered
+        removed = db.execute("DELETE FROM courses WHERE term = ? AND updated < ?", (sterm, started)).rowcount
+        if removed:
+            print("Removed %d teaching class(es) no longer offered" % removed)
+    db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)", (key, time.time(), count))
+    db.commit()
+    db.close()
+    logging.info("Catalog [%s] synced: %d teaching class(es)" % (key, count))
+    return count
+
+
+_catalogcolumns = "courseid, teacherid, coursename, teachername, credit, timetext, capacity, number, restriction"
+
+
+def catalogrow(row):  # convert a row of the catalog to Courseinfo
+    return Courseinfo(courseid=row[0], teacherid=row[1], coursename=row[2], teachername=row[3], credit=row[4],
+                      timetext=row[5], capacity=row[6], number=row[7], restriction=row[8])
+
+
+def searchcatalog(keyword, notfull=False):  # search the catalog by course id, course name, teacher id or name
+    if not os.path.exists(CATALOGPATH):
+        return []
+    db = opencatalog()
+    sql = "SELECT %s FROM courses WHERE (courseid LIKE ? OR coursename LIKE ? OR teacherid = ? OR teachername LIKE ?)" \
+          % _catalogcolumns
+    args = [keyword + "%", "%" + keyword + "%", keyword, "%" + keyword + "%"]
+    if sterm:  # only the term in config, or every term if it is not known yet
+        sql += " AND term = ?"
+        args.append(sterm)
+    if notfull:
+        sql += " AND number < capacity"
+    sql += " ORDER BY courseid, teacherid"
+    rows = db.execute(sql, args).fetchall()
+    db.close()
+    return [catalogrow(row) for row in rows]
+
+
+def catalogsections(cid):  # all teaching classes of a course in the catalog
+    if not os.path.exists(CATALOGPATH):
+        return []
+    db = opencatalog()
+    rows = db.execute("SELECT %s FROM courses WHERE courseid = ? AND term = ? ORDER BY teacherid" % _catalogcolumns,
+                      (cid, sterm)).fetchall()
+    db.close()
+    return [catalogrow(row) for row in rows]
+
+
+def openhistory():  # open the local history store, creating tables if needed
+    sqlite3 = lazyimport("sqlite3")
+    db = sqlite3.connect(HISTORYPATH)
+    db.execute("""CREATE TABLE IF NOT EXISTS observations (
+                      courseid TEXT, teacherid TEXT, ts REAL, capacity INTEGER, number INTEGER, restriction TEXT)""")
+    db.execute("CREATE INDEX IF NOT EXISTS observations_section ON observations (courseid, teacherid, ts)")
+    # releases are detected from consecutive raw observations, which downsampling does not keep
+    db.execute("CREATE TABLE IF NOT EXISTS releases (courseid TEXT, teacherid TEXT, ts REAL, seats INTEGER)")
+    db.execute("CREATE INDEX IF NOT EXISTS releases_section ON releases (courseid, teacherid, ts)")
+    return db
+
+
+def secondofday(ts):
+    t = time.localtime(ts)
+    return t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+
+
+def recordobservation(course):  # buffer an observation of getCourseInfo, flushed by flushhistory
+    if course.restriction.startswith("Error Occurred"):
+        return
+    now = time.time()
+    key = (course.courseid, course.teacherid)
+    # not across runs or pauses of polling
+    if key in lastnumbers and course.number < lastnumbers[key][0] and now - lastnumbers[key][1] <= history_bucket:
+        releasetimes.setdefault(key, []).append(secondofday(now))  # a seat has been released just now
+        releasebuffer.append((course.courseid, course.teacherid, now, lastnumbers[key][0] - course.number))
+    lastnumbers[key] = (course.number, now)
+    historybuffer.append((course.courseid, course.teacherid, now, course.capacity, course.number, course.restriction))
+
+
+def flushhistory():  # write the buffered observations and releases
+    if not historybuffer and not releasebuffer:
+        return
+    rows = historybuffer[:]
+    del historybuffer[:len(rows)]
+    releases = releasebuffer[:]
+    del releasebuffer[:len(releases)]
+    try:
+        db = openhistory()
+        db.executemany("INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?)", rows)
+        db.executemany("INSERT INTO releases VALUES (?, ?, ?, ?)", releases)
+        db.commit()
+        db.close()
+    except Exception as emsg:
+        logging.warning("Unable to write history: %s" % emsg)
+
+
+def downsamplehistory():  # keep one observation per bucket for old observations, the one with most vacancies
+    db = openhistory()
+    cutoff = time.time() - history_keep_raw
+    db.execute("""CREATE TEMP TABLE kept AS
+                  SELECT courseid, teacherid, CAST(ts / ? AS INTEGER) * ? AS ts, capacity, MIN(number) AS number,
+                         restriction
+                  FROM observations WHERE ts < ? GROUP BY courseid, teacherid, CAST(ts / ? AS INTEGER)""",
+               (history_bucket, history_bucket, cutoff, history_bucket))
+    db.execute("DELETE FROM observations WHERE ts < ?", (cutoff,))
+    db.execute("INSERT INTO observations SELECT * FROM kept")
+    db.commit()
+    db.close()
+
+
+def seatreleases(cid, tid):  # times when seats of a section were released, with the number of seats
+    if not os.path.exists(HISTORYPATH):
+        return []
+    db = openhistory()
+    releases = db.execute("SELECT ts, seats FROM releases WHERE courseid = ? AND teacherid = ? ORDER BY ts",
+                          (cid, tid)).fetchall()
+    db.close()
+    return releases
+
+
+def showhistory(cid, tid):  # print past releases of a section by time of day
+    releases = seatreleases(cid, tid)
+    buckets = {}
+    for ts, n in releases:
+        bucket = secondofday(ts) // 600 * 600
+        buckets[bucket] = buckets.get(bucket, 0) + n
+    print("%d release(s) of %d seat(s) recorded for %s,%s" % (len(releases), sum(n for _, n in releases), cid, tid))
+    for bucket, n in sorted(buckets.items()):
+        print("%02d:%02d-%02d:%02d %4d %s" % (bucket // 3600, bucket % 3600 // 60, (bucket + 600) // 3600 % 24,
+                                            (bucket + 600) % 3600 // 60, n, "#" * min(n, 50)))
+    for ts, n in releases[-10:]:
+        print("%s  +%d" % (datetime.datetime.fromtimestamp(ts).strftime(DATE_FORMAT), n))
+
+
+def loadreleases(items):  # load past releases of the targets for releaseweight
+    for item in items:
+        for tid in item.group or (item.teacherid,):
+            releasetimes[(item.courseid, tid)] = [secondofday(ts) for ts, _ in seatreleases(item.courseid, tid)]
+
+
+def releaseweight(item, now):  # how much more likely seats of a target are released around now than on average
+    weight = 0.0
+    sod = secondofday(now)
+    for tid in item.group or (item.teacherid,):
+        times = releasetimes.get((item.courseid, tid), [])
+        near = sum(1 for x in times if min(abs(x - sod), 86400 - abs(x - sod)) <= release_window)
+        expected = len(times) * 2 * release_window / 86400
+        weight = max(weight, (near + 1) / (expected + 1))  # 1 without history
+    return weight
+
+
+def pollinterval(item, now):  # poll less often in quiet periods, never more often than querydelay
+    return query_delay / min(max(releaseweight(item, now), 1 / 3), 1)
+
+
+def parsetimeslots(timetext):  # analyze time text like "一1-2 三3-4(1-5周)" into sets of (day, period)
+    # slots qualified by weeks in brackets only occupy some weeks, they are returned separately as possible conflicts
+    certain = set()
+    partial = set()
+    for day, first, last, weeks in _timeslot.findall(timetext):
+        slots = {(day, p) for p in range(int(first), int(last or first) + 1)}
+        if weeks:
+            partial |= slots
+        else:
+            certain |= slots
+    return certain, partial
+
+
+@lazyretry
+def getSelectedCourses(sess):  # query the current timetable
+    r = sess.post(_baseurl + _selectedcourse)
+    while _termindex in r.url:
+        printf("\nYou have logged in elsewhere:(  Need to select term first...")
+        logging.warning("Query Course Table Failed. Retry selecting term")
+        sess = selectTerm(sterm, sess, False)
+        r = sess.post(_baseurl + _selectedcourse)
+    html = lazyimport("lxml.etree").HTML(r.text)
+    result = []
+    for row in html.xpath("//table/tr[td]"):
+        cells = ["".join(td.xpath(".//text()")).strip() for td in row.xpath("./td")]
+        # locate the columns by content, the course id is the first 8-digit cell and the teacher id follows it
+        cidx = next((j for j, x in enumerate(cells) if re.fullmatch(r"\d{8}", x)), -1)
+        if cidx == -1:
+            continue
+        tidx = next((j for j in range(cidx + 1, len(cells)) if re.fullmatch(r"\d{4}", cells[j])), -1)
+        if tidx == -1:
+            continue
+        timetext = next((x for x in cells[tidx + 1:] if _timeslot.search(x)), "")
+        result.append(Selectedcourse(courseid=cells[cidx],
+                                     coursename=cells[cidx + 1] if cidx + 1 < tidx else "",
+                                     teacherid=cells[tidx],
+                                     teachername=cells[tidx + 1] if tidx + 1 < len(cells) else "",
+                                     timetext=timetext))
+    logging.info("%d course(s) in the timetable" % len(result))
+    return result
+
+
+def findconflicts(cid, tid, replacecid, replacetid):  # selected courses conflicting with a section
+    # returns (certain, possible), the course to be replaced will be dropped and never conflicts
+    certain = []
+    possible = []
+    slots, partialslots = parsetimeslots(sectiontimes.get((cid, tid), ""))
+    for course in selectedlist:
+        if course.courseid == replacecid and course.teacherid == replacetid:
+            continue
+        if course.courseid == cid:
+            certain.append(course)  # the course is already selected
+            continue
+        cslots, cpartialslots = parsetimeslots(course.timetext)
+        if slots & cslots:
+            certain.append(course)
+        elif (slots | partialslots) & (cslots | cpartialslots):
+            possible.append(course)
+    return certain, possible
+
+
+def precomputeconflicts(sess):  # fetch the timetable and find targets that can never be selected
+    global selectedlist
+    # queries go outside listlock, the decision engine only waits for the recheck
+    selected = getSelectedCourses(sess)
+    catalogtimes = {}
+    for item in list(inputlist):  # sections not polled yet take their time text from the catalog, learnsectiontimes the rest
+        for course in catalogsections(item.courseid):
+            catalogtimes[(course.courseid, course.teacherid)] = course.timetext
+    with listlock:
+        selectedlist = selected
+        for key, timetext in catalogtimes.items():
+            sectiontimes.setdefault(key, timetext)
+        conflictmap.clear()
+        for item in list(inputlist):
+            for tid in item.group or (item.teacherid,):
+                checksection(item, tid)
+            dropifconflicting(item)
+
+
+def tryprecomputeconflicts(sess):
+    try:
+        precomputeconflicts(sess)
+    except Exception as emsg:  # conflicts will be found by the server anyway
+        logging.warning("Unable to precompute conflicts: %s" % emsg)
+
+
+def checksection(item, tid):  # check a section of a target against the timetable
+    certain, possible = findconflicts(item.courseid, tid, item.replacecid, item.replacetid)
+    conflictmap.pop((item.courseid, tid), None)
+    if certain:
+        conflictmap[(item.courseid, tid)] = certain
+        print("%s,%s conflicts with %s" % (item.courseid, tid, ", ".join(str_coursebaseinfo(x) for x in certain)))
+        if len(certain) == 1 and certain[0].courseid != item.courseid and item.replacecid == "null":
+            print("Enter %s,%s,%s,%s to replace it automatically" % (
+                item.courseid, tid, certain[0].courseid, certain[0].teacherid))
+    elif possible:
+        print("%s,%s may conflict with %s in some weeks" % (
+            item.courseid, tid, ", ".join(str_coursebaseinfo(x) for x in possible)))
+
+
+def learnsectiontimes(item, sections):  # take the time text of target sections from a poll instead of another query
+    # returns whether the time of any section was new, in which case it has been checked against the timetable
+    tids = item.group or (item.teacherid,)
+    learnt = False
+    for course in sections:
+        key = (course.courseid, course.teacherid)
+        if course.teacherid in tids and course.timetext and sectiontimes.get(key) != course.timetext:
+            sectiontimes[key] = course.timetext
+            checksection(item, course.teacherid)
+            learnt = True
+    return learnt
+
+
+def dropifconflicting(item):  # stop selecting a target if all of its sections conflict, returns whether it is dropped
+    if all(isconflicting(item.courseid, tid) for tid in item.group or (item.teacherid,)) \
+            and findtargetinlist(item.courseid, item.teacherid) != -1:
+        deletecoursefromlist(item.courseid, item.teacherid)
+        printnwarn("Please change courses conflicting with %s manually, and add it again" % item.courseid)
+        return True
+    return False
+
+
+def isconflicting(cid, tid):  # judge whether a section certainly conflicts with the timetable
+    return (cid, tid) in conflictmap or (cid, tid) in rejectedsections
+
+
+@lazyretry
 def checkDiffCampus(param, sess):
     r = sess.post(_baseurl + _diffcampus, param)
     if any(x in r.text for x in ["点击选择选课学期","未将对象引用设置到对象的实例"]):
@@ -431,26 +939,33 @@ def checkDiffCampus(param, sess):
     return
 
 
-@retry(stop=stop_after_attempt(10), wait=wait_fixed(0.25))
+@lazyretry
 def returnCourse(courses, sess):  # return a list of courses
+    datastr = dropdata(courses)
+    r = sess.post(_baseurl + _dropcourse, data=datastr, headers=_formheaders)
+    while _termindex in r.url:
+        printf("\nYou have logged in elsewhere:(  Need to select term first...")
+        logging.warning("Return Course Failed. Retry selecting term")
+        sess = selectTerm(sterm, sess, False)
+        r = sess.post(_baseurl + _dropcourse, data=datastr, headers=_formheaders)
+    return isdropped(r)
+
+
+def dropdata(courses):  # form of CourseReturnSave for the courses to be replaced
     datastr = ""
     for course in courses:
         datastr += ("&cids=" + course.replacecid)
     for course in courses:
         datastr += ("&tnos=" + course.replacetid)
-    headers = {'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8'}
-    r = sess.post(_baseurl + _dropcourse, data=datastr[1:], headers=headers)
-    while _termindex in r.url:
-        printf("\nYou have logged in elsewhere:(  Need to select term first...")
-        logging.warning("Return Course Failed. Retry selecting term")
-        sess = selectTerm(sterm, sess, False)
-        r = sess.post(_baseurl + _dropcourse, data=datastr[1:], headers=headers)
+    return datastr[1:]
+
+
+def isdropped(r):  # judge whether returning courses succeeded given the response
     return ("退课成功" in r.text) and ("无此教学班数据" not in r.text) and ("未选此教学班" not in r.text)
     # TODO: verify the result of each course
 
 
-@retry(stop=stop_after_attempt(10), wait=wait_fixed(0.25))
-def selectCourse(courses, sess):  # select a list of courses
+def selectparams(courses):  # form of CourseSelectionSave for a list of courses
     params = {}
     i = 0
     for course in courses:
@@ -462,15 +977,73 @@ def selectCourse(courses, sess):  # select a list of courses
     for j in range(i, 9):
         params["cids[%d]" % j] = ""
         params["tnos[%d]" % j] = ""
+    return params
+
+
+def replaceCourse(submitlist, droplist, sess):  # drop the courses to be replaced and select right after
+    # Both requests are prepared in advance and nothing happens between the drop response and sending the select
+    # request, so the dropped seats are exposed for about one round trip. Returns whether dropping succeeded and the
+    # result
+    params = selectparams(submitlist)
+    datastr = dropdata(droplist)
+    if warn_diff_campus:
+        checkDiffCampus(params, sess)  # only a warning, check it before the seats are exposed
+    requests = lazyimport("requests")
+    dropurl = _baseurl + _dropcourse
+    selecturl = _baseurl + _selectcourse
+    # sess.post would merge the session, encode the form and build the headers after the drop returns
+    dropreq = sess.prepare_request(requests.Request("POST", dropurl, data=datastr, headers=_formheaders))
+    selectreq = sess.prepare_request(requests.Request("POST", selecturl, data=params))
+    settings = sess.merge_environment_settings(selecturl, {}, None, None, None)
+    try:
+        start = time.perf_counter()
+        rd = sess.send(dropreq, **settings)
+    except Exception as emsg:  # not known whether anything was dropped
+        logging.warning("Returning courses failed: %s. Retry one by one" % emsg)
+        return returnCourse(droplist, sess), selectCourse(submitlist, sess)
+    dropped = time.perf_counter()
+    rs = None
+    for attempt in range(3):  # the seats may be exposed already, send nothing but the prepared select
+        sending = time.perf_counter()
+        if attempt == 0:
+            dispatch = sending - dropped
+        try:
+            rs = sess.send(selectreq, **settings)
+            break
+        except Exception as emsg:
+            logging.warning("Selecting courses after dropping failed: %s" % emsg)
+    selected = time.perf_counter()
+    gap = Replacementgap(droprtt=dropped - start, dispatch=dispatch, exposed=selected - dropped)
+    replacementgaps.append(gap)
+    logging.info("Drop round trip %.1f ms, drop-to-select gap %.1f ms (select sent after %.2f ms)" % (
+        gap.droprtt * 1000, gap.exposed * 1000, gap.dispatch * 1000))
+    if gap.dispatch > max_dispatch_delay:
+        logging.warning("Select request was sent %.2f ms after the drop response" % (gap.dispatch * 1000))
+    if _termindex in rd.url:  # logged in elsewhere, nothing was dropped
+        printf("\nYou have logged in elsewhere:(  Need to select term first...")
+        logging.warning("Return Course Failed. Retry selecting term")
+        return returnCourse(droplist, sess), selectCourse(submitlist, sess)
+    if rs is None:  # keep trying with the usual retries rather than leave the dropped seats to others
+        return isdropped(rd), selectCourse(submitlist, sess)
+    return isdropped(rd), parseselection(rs, params, sess)
+
+
+@lazyretry
+def selectCourse(courses, sess):  # select a list of courses
+    params = selectparams(courses)
     if warn_diff_campus:
         checkDiffCampus(params, sess)
     r = sess.post(_baseurl + _selectcourse, params)
+    return parseselection(r, params, sess)
+
+
+def parseselection(r, params, sess):  # analyze the response of CourseSelectionSave
     while "未指定当前选课学期！" in r.text:
         printf("You have logged in elsewhere:(  Need to select term first...")
         logging.warning("Select Course Failed. Retry selecting term")
         sess = selectTerm(sterm, sess, False)
         r = sess.post(_baseurl + _selectcourse, params)
-    html = lxml.etree.HTML(r.text)
+    html = lazyimport("lxml.etree").HTML(r.text)
     table_rows = html.xpath("//table/tr/td/..")
     if len(table_rows) <= 1:
         # Something wrong, select term first
@@ -480,7 +1053,7 @@ def selectCourse(courses, sess):  # select a list of courses
             logging.critical("Selection period appears to be ended")
             raise RuntimeError("Selection period appears to be ended")
         r = sess.post(_baseurl + _selectcourse, params)
-        html = lxml.etree.HTML(r.text)
+        html = lazyimport("lxml.etree").HTML(r.text)
         table_rows = html.xpath("//table/tr/td/..")
         if len(table_rows) <= 1:  # retry one time
             printf("Something Wrong :(")
@@ -511,7 +1084,7 @@ def selectCourse(courses, sess):  # select a list of courses
     return result
 
 
-@retry(stop=stop_after_attempt(10), wait=wait_fixed(0.25))
+@lazyretry
 def isSelectTime(sess):  # judge whether it is selection time
     r = sess.get(_baseurl + _fastinput)
     if "非本校区提示" in r.text:
@@ -521,11 +1094,12 @@ def isSelectTime(sess):  # judge whether it is selection time
         return False
 
 
-@retry(stop=stop_after_attempt(10), wait=wait_fixed(0.25))
+@lazyretry
 def selectTerm(term, sess, dtips=True):  # select the term
     global sterm
     sterm = term
-    r = sess.post(_baseurl + _termselect, {"termId": term})
+    with sessionlock:  # the poller copies the cookies only before or after this
+        r = sess.post(_baseurl + _termselect, {"termId": term})
     if "学生信息" in r.text and "未选择" not in r.text:
         print("-------------------------")
     else:
@@ -553,7 +1127,7 @@ def selectTerm(term, sess, dtips=True):  # select the term
 def login(username, encryptpwd):
     global sterm
     print("Logging in...")
-    session = requests.Session()
+    session = lazyimport("requests").Session()
     try:
         r = session.get(_baseurl)
     except Exception as emsg:
@@ -611,260 +1185,694 @@ def login(username, encryptpwd):
             return selectTerm(Termlist[0].termid, session)
 
 
-count = 0
-while count < 6:
+def reconcile(submitlist, result, dropsuccess):  # update the inputlist given the selection results of submitted items
+    for item in submitlist:
+        rid = findcourseinlist(item.courseid, item.teacherid, result)  # find in result
+        selection = result[rid]
+        if item.replacecid != "null" and item.replacecid != "backup":  # Has backup
+            rid2 = findcourseinlist(item.replacecid, item.replacetid, result)  # Find the result of backup selection
+            # if selection is success and backupselection is not success: replacement successful, delete from task
+            # if selection failed but backup selection is success: replacement not successful, continue loop
+            # if selection and backup both failed: continue loop
+            printf(str_selectionresult(selection))
+            logging.info("Target  Course %s" % str_selectionresult(selection))
+            if selection.isSuccess:
+                if not result[rid2].isSuccess:  # Best situation
+                    printf("Previously selected course %s had been automatically returned" % str_coursebaseinfo(result[rid2]))
+                    logging.info("Previously selected course %s had been automatically returned" % str_coursebaseinfo(result[rid2]))
+                else:  # Exceptional situation: User entered two courses that are not conflicting, TODO(maybe):return the unwanted course
+                    printf(str_selectionresult(result[rid2]))
+                    printf(
+                        "The two courses are not conflicting, both are selected, you might want to manually return one of them")
+                    logging.info("Backup Course %s" % str_selectionresult(result[rid2]))
+                deletecoursefromlist(selection.courseid, selection.teacherid)  # remove from task due to success
+            else:  # not selection.isSuccess
+                printf(str_selectionresult(result[rid2]))
+                logging.info("Backup Course %s" % str_selectionresult(result[rid2]))
+                if result[rid2].isSuccess:
+                    printf("Course replacement failed, the course you previously selected had been selected back")
+                    # if target course selection failed with certain reason, discontinue
+                    if isfinal(selection):
+                        deletecoursefromlist(selection.courseid, selection.teacherid)
+                        if "已选此课程" in selection.msg:
+                            printnwarn("Please return the course %s manually, and add it again" % selection.coursename)
+                        if any(x in selection.msg for x in _stop_condition):
+                            printnwarn(
+                                "Please change courses conflicting with %s manually, and add it again" % selection.coursename)
+                        printnwarn(
+                            "Due to unresolved conflicts in selecting the target course, the program will stop selecting this course")
+                    else:
+                        printf("The program will continue trying to replace the course")
+                else:  # Exceptional or Unfortunate situation: Both courses are dropped
+                    if "无此教学班数据" in result[rid2].msg:
+                        printnwarn("Invalid Return Course Data")
+                        deletecoursefromlist(selection.courseid, selection.teacherid)
+                        # remove original item first
+                        inputlist.append(item._replace(replacecid="null", replacetid="null"))
+                        logging.info("Add %s,%s to list" % (item.courseid, item.teacherid))
+                        # add an item without replacement
+                    else:
+                        if any(x in selection.msg for x in _stop_condition2):
+                            if dropsuccess == 1:  # drop success
+                                printnwarn(
+                                    "Seems impossible to replace course, please check selection strategy and retry")
+                                deletecoursefromlist(selection.courseid, selection.teacherid)  # discontinue
+                            if dropsuccess == -1 and ("已选此课程" in result[rid2].msg) or any(x in result[rid2].msg for x in _stop_condition):
+                                printnwarn("Seems unable to select the original course back, did you select it?")
+                                deletecoursefromlist(selection.courseid, selection.teacherid)  # discontinue
+                            else:
+                                if dropsuccess == -1:
+                                    printf(
+                                        "It seems that the error relates to failure in returning courses, the program will retry")
+                        else:
+                            printf(
+                                "Unfortunately, failed to select both courses, trying to select either of the courses")
+                            deletecoursefromlist(selection.courseid, selection.teacherid)
+                            logging.warning("Cannot Select both course. Add %s,%s ; %s,%s to list" % (
+                                item.courseid, item.teacherid, item.replacecid, item.replacetid))
+                            # remove original item first
+                            inputlist.append(item._replace(replacecid="null", replacetid="null"))
+                            # add an item without replacement
+                            inputlist.append(Courseitem(item.replacecid, item.replacetid, "null", "null"))
+                            # add the original course to tasks
+        else:
+            if item.replacecid != "backup":
+                printf(str_selectionresult(selection))
+                logging.info("Target  Course %s" % str_selectionresult(selection))
+                if not selection.isSuccess and item.group and "课时冲突" in selection.msg \
+                        and not all(isconflicting(item.courseid, x) for x in item.group if x != item.teacherid):
+                    rejectedsections.add((item.courseid, item.teacherid))  # only this section conflicts
+                    printf("Section %s,%s will be skipped, trying other sections" % (item.courseid, item.teacherid))
+                elif isfinal(selection):
+                    deletecoursefromlist(selection.courseid, selection.teacherid)
+                    # success or need user actions, discontinue
+                    if "已选此课程" in selection.msg:
+                        printnwarn("Please return the course %s manually, and add it again" % selection.coursename)
+                    if any(x in selection.msg for x in _stop_condition):
+                        printnwarn(
+                            "Please change courses conflicting with %s manually, and add it again" % selection.coursename)
+                    printf(
+                        "You may also edit the config to let the program automatically return conflicting courses")
+            # else is backup, ok to skip
+        del result[rid]  # We don't need this result item anymore
+        print()
+
+
+def targetkey(item):  # identify a target in targetstates, all sections of a group share the key
+    return item.courseid, item.group[0] if item.group else item.teacherid
 
+
+def runstage(stage, *args):  # run a stage of the pipeline, stopping the whole pipeline if it fails
     try:
-        print("SCourseHelper V" + VER)
-        print()
-        print("FREE, Open Source on https://github.com/hidacow/SHU-CourseHelper")
-        print()
-        print()
-        print("Reading Config...", end="")
-        readconfig()
-        print()
-        if keep_logs == True:
-            logging.basicConfig(filename=LOGPATH, format=LOG_FORMAT, datefmt=DATE_FORMAT, level=logging_level)
-            print("Logging is ENABLED. Program logs can be found at %s\n" % LOGPATH)
-        else:
-            logging.disable(100)
+        stage(*args)
+    except Exception as e:
+        logging.exception("Stage %s failed" % stage.__name__)
+        pipelineerrors.append(e)
+        stopevent.set()
+
+
+def syncsession(source, target):  # copy the login cookies, e.g. after the submitter selected term again
+    with sessionlock:
+        target.cookies.update(source.cookies)
 
-        logging.info("SCourseHelper V%s started." % VER)
-        if username == "":
-            username = input("User:")
-        else:
-            print("User:%s" % username)
-        if password == "" and encryptedpassword == "":
-            password = getpass.getpass("Password:")
 
-        if encryptedpassword != "":
-            s = login(username, encryptedpassword)
+def pollerstage(sess):  # poll the targets that are not being submitted, as soon as each result is known
+    # requests.Session is not thread-safe, the poller uses a session of its own with the same login cookies
+    pollsess = lazyimport("requests").Session()
+    i = 0
+    while not stopevent.is_set():
+        syncsession(sess, pollsess)
+        if i > 0:
+            if auto_cls:
+                clear()
+            print()
+            print('#' * 50)
+            print()
+            print("Retry:%d" % i)
+        now = time.time()
+        targets = [x for x in list(inputlist) if targetstates.get(targetkey(x), "polling") == "polling"
+                   and nextpolls.get(targetkey(x), 0) <= now]
+        print("Checking %d course(s)" % len(targets), end="\n\n")
+        print("-------------------------")
+        for item in targets:
+            if stopevent.is_set():
+                return
+            if item.group:  # poll all sections of the group in one query
+                try:
+                    sections = getCourseSections(item.courseid, pollsess)
+                except Exception as emsg:
+                    logging.warning("Error Occurred when querying %s: %s" % (str_group(item), emsg))
+                    sections = []
+                for course in sections:
+                    if course.teacherid in item.group:
+                        print(str_courseinfo(course))
+            else:
+                sections = [getCourseInfo(item.courseid, item.teacherid, pollsess)]
+                print(str_courseinfo(sections[0]))
+            decideq.put((item, sections))
+            nextpolls[targetkey(item)] = time.time() + pollinterval(item, time.time())
+        print("-------------------------", end="\n\n")
+        now = time.time()
+        due = [nextpolls.get(targetkey(x), now) for x in list(inputlist)
+               if targetstates.get(targetkey(x), "polling") == "polling"]
+        wait = min(due or [now + query_delay]) - now
+        wait = min(max(wait, 0), query_delay * 3)
+        print("%d course(s) remaining...Wait %.2f sec..." % (len(inputlist), wait))
+        logging.debug("%d course(s) remaining" % len(inputlist))
+        i += 1
+        stopevent.wait(wait)
+
+
+def decisionstage():  # choose the section to submit for every observation of a target
+    while not stopevent.is_set():
+        try:
+            item, sections = decideq.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        for course in sections:
+            recordobservation(course)  # written by historystage
+        key = targetkey(item)
+        if targetstates.get(key, "polling") != "polling":
+            continue  # submitted or finished since it was polled
+        with listlock:
+            if learnsectiontimes(item, sections) and dropifconflicting(item):
+                targetstates[key] = "done"
+                if len(inputlist) == 0:
+                    printf("No course can be selected without conflicts")
+                    stopevent.set()
+                continue
+        if item.group:
+            course = choosesection(item, sections)
+        else:
+            course = sections[0] if canSelect(sections[0]) and not isconflicting(item.courseid, item.teacherid) else None
+        if course is None:
+            continue
+        print("%s(%s) by %s(%s) can be selected!!" % (course.coursename, course.courseid, course.teachername,
+                                                     course.teacherid))
+        targetstates[key] = "submitting"
+        submitq.put(item._replace(teacherid=course.teacherid))
+
+
+def submitterstage(sess):  # submit the chosen sections, batching those chosen while the previous batch was in flight
+    pending = []
+    while not stopevent.is_set():
+        if not pending:
+            try:
+                pending.append(submitq.get(timeout=0.5))
+            except queue.Empty:
+                continue
+        while True:
+            try:
+                pending.append(submitq.get_nowait())
+            except queue.Empty:
+                break
+        SubmitList = []
+        DropList = []
+        while pending:  # CourseSelectionSave takes at most 9 courses, a replacement takes two of them
+            item = pending[0]
+            if len(SubmitList) + (1 if item.replacecid == "null" else 2) > 9:
+                break
+            del pending[0]
+            SubmitList.append(item)
+            if item.replacecid != "null":
+                DropList.append(item)
+                SubmitList.append(Courseitem(item.replacecid, item.replacetid, "backup",
+                                             "backup"))  # select it back in case of failure
+        printf("Trying to select %d course(s)..." % (len(SubmitList) - len(DropList)), end="\n\n")
+        logging.info("%d course(s) can be selected" % (len(SubmitList) - len(DropList)))
+        dropsuccess = 0
+        if len(DropList) > 0:  # Drop the replace courses first, and select right after
+            logging.info("%d course(s) need to be dropped first" % len(DropList))
+            ngaps = len(replacementgaps)
+            dropped, result = replaceCourse(SubmitList, DropList, sess)
+            printf("Need to drop %d course(s)..." % len(DropList), end="")
+            if dropped:
+                printf("Success")
+                dropsuccess = 1
+            else:
+                printf("Failed, continue anyway")
+                logging.warning("Cannot to return some courses")
+                dropsuccess = -1
+            if len(replacementgaps) > ngaps:
+                print("Drop round trip %.1f ms, drop-to-select gap %.1f ms" % (
+                    replacementgaps[-1].droprtt * 1000, replacementgaps[-1].exposed * 1000))
         else:
-            s = login(username, encryptPass(password))
+            result = selectCourse(SubmitList, sess)
+        timetablechanged = any(x.isSuccess for x in result)
+        with listlock:  # the decision engine may drop conflicting targets meanwhile
+            reconcile(SubmitList, result, dropsuccess)
+            for item in SubmitList:
+                if item.replacecid != "backup":
+                    found = findtargetinlist(item.courseid, item.teacherid) != -1
+                    targetstates[targetkey(item)] = "polling" if found else "done"
+            remaining = len(inputlist)
+        if timetablechanged and remaining > 0:  # selected courses may conflict with other targets now
+            tryprecomputeconflicts(sess)
+        with listlock:
+            if len(inputlist) == 0 and not stopevent.is_set():  # unless the decision engine stopped meanwhile
+                printf("Task done!")
+                logging.info("All Task Done!")
+                stopevent.set()
+                return
+
+
+def historystage():  # compact old observations and write new ones, so that no other stage waits for SQLite
+    try:
+        downsamplehistory()
+    except Exception as emsg:
+        logging.warning("Unable to downsample history: %s" % emsg)
+    while not stopevent.wait(history_flush):
+        flushhistory()
 
-        if not isSelectTime(s):
-            i = 0
-            print("Not Selection Time...Wait %.2f sec..." % chk_select_time_delay)
-            logging.warning("Not Selection Time")
-            while True:
-                print("Retry Times: " + str(i))
-                time.sleep(chk_select_time_delay)
-                i += 1
-                if isSelectTime(s):
-                    break
 
-        print("Selection Time OK", end="\n\n")
-        if len(inputlist) == 0:
-            i = 1
-            print("Enter the courses in the config is recommended. See README for more info\n")
+def reporterstage():  # print, log and email the messages, so that no other stage waits for SMTP
+    while True:
+        mess = reportq.get()
+        if mess is None:
+            return
+        send(mess)
+
+
+def runpipeline(sess):  # run the stages until all targets are done, raise the error if a stage failed
+    global decideq, submitq, reportq, stopevent
+    decideq = queue.Queue()
+    submitq = queue.Queue()
+    reportq = queue.Queue()
+    stopevent = threading.Event()
+    targetstates.clear()
+    pipelineerrors.clear()
+    nextpolls.clear()
+    try:
+        loadreleases(inputlist)
+    except Exception as emsg:
+        logging.warning("Unable to load history: %s" % emsg)
+    stages = [threading.Thread(target=runstage, args=(pollerstage, sess), name="poller", daemon=True),
+              threading.Thread(target=runstage, args=(decisionstage,), name="decision", daemon=True),
+              threading.Thread(target=runstage, args=(submitterstage, sess), name="submitter", daemon=True),
+              threading.Thread(target=runstage, args=(historystage,), name="history", daemon=True)]
+    reporter = threading.Thread(target=reporterstage, name="reporter", daemon=True)
+    reporter.start()
+    reportq.put("开始了")  # SMTP login happens in the reporter, never before the first query
+    for stage in stages:
+        stage.start()
+    try:
+        while not stopevent.wait(1):
+            pass
+    finally:
+        stopevent.set()
+        for stage in stages:
+            stage.join()
+        flushhistory()
+        reportq.put(None)  # send the remaining messages before leaving
+        reporter.join()
+        reportq = None
+    if pipelineerrors:
+        raise pipelineerrors[0]
+
+
+def simulateround(strategy, scenario, rng):  # simulate a selection round in virtual time
+    # returns (time to seat or None, number of requests)
+    heap = []
+    number = [scenario.capacity] * scenario.sections  # every section is full at first
+    seq = 0
+    now = 0.0
+
+    def schedule(t, kind, k):
+        nonlocal seq
+        seq += 1
+        heapq.heappush(heap, (t, seq, kind, k))
+
+    def advance(t):  # process the events of seat releases and competitors until t
+        nonlocal now
+        while heap and heap[0][0] <= t:
+            et, _, kind, k = heapq.heappop(heap)
+            if kind == "release":
+                if number[k] > 0:
+                    number[k] -= 1
+                    schedule(et + rng.expovariate(scenario.competitors / scenario.reaction), "grab", k)
+                schedule(et + rng.expovariate(scenario.release_rate / 60), "release", k)
+            elif number[k] < scenario.capacity:  # grab
+                number[k] += 1
+        now = t
+
+    def rtt():
+        return rng.lognormvariate(math.log(scenario.latency), 0.5)
+
+    def query(ks):  # one query of QueryCourseList, the server answers in the middle of the round trip
+        delay = rtt()
+        advance(now + delay / 2)
+        if rng.random() < scenario.error_rate:
+            infos = [Courseinfo(courseid=cid, coursename="SIM", teacherid=tids[k], teachername="SIM", capacity=0,
+                                number=0, restriction="Error Occurred: 500 Retry...") for k in ks]
+        else:
+            infos = [Courseinfo(courseid=cid, coursename="SIM", teacherid=tids[k], teachername="SIM",
+                                capacity=scenario.capacity, number=number[k], restriction="") for k in ks]
+        advance(now + delay / 2)
+        return infos
+
+    cid = "00000000"
+    tids = ["%04d" % (k + 1) for k in range(scenario.sections)]
+    item = Courseitem(cid, tids[0], "null", "null", tuple(tids) if strategy.group else ())
+    for k in range(scenario.sections):
+        schedule(rng.expovariate(scenario.release_rate / 60), "release", k)
+    requests = 0
+    while now < scenario.window:
+        ks = range(scenario.sections) if strategy.group else [0]
+        if strategy.batched:
+            sections = query(ks)
+            requests += 1
+        else:
+            sections = []
+            for k in ks:
+                sections += query([k])
+                requests += 1
+        course = choosesection(item._replace(group=item.group or (item.teacherid,)), sections)
+        if course is not None and (course.number < course.capacity or not strategy.fullcheck):
+            k = tids.index(course.teacherid)
+            delay = rtt()
+            advance(now + delay / 2)
+            requests += 1
+            if rng.random() < scenario.error_rate:
+                msg = "Error"
+            elif number[k] < scenario.capacity:
+                number[k] += 1
+                msg = "选课成功"
+            else:
+                msg = "人数已满"
+            advance(now + delay / 2)
+            selection = Selectionresult(courseid=cid, coursename="SIM", teacherid=course.teacherid, teachername="SIM",
+                                        msg=msg, isSuccess="成功" in msg)
+            if isfinal(selection):
+                return (now if selection.isSuccess else None), requests
+        advance(now + strategy.query_delay)
+    return None, requests
+
+
+def simulate(strategies, scenario, rounds, seed=0):  # evaluate strategies by simulating rounds of selection
+    import random
+    import statistics
+    print("Simulating %d round(s) of %d sec, %d section(s), %.2f seat(s)/min released per section" % (
+        rounds, scenario.window, scenario.sections, scenario.release_rate))
+    print("%-24s %8s %12s %12s %10s" % ("Strategy", "Success", "Mean seat", "Median seat", "Requests"))
+    for strategy in strategies:
+        rng = random.Random(seed)  # every strategy faces the same rounds
+        times = []
+        requests = 0
+        for _ in range(rounds):
+            t, n = simulateround(strategy, scenario, rng)
+            requests += n
+            if t is not None:
+                times.append(t)
+        print("%-24s %7.1f%% %11.1fs %11.1fs %10.1f" % (
+            strategy.name, 100 * len(times) / rounds, statistics.mean(times) if times else float("nan"),
+            statistics.median(times) if times else float("nan"), requests / rounds))
+
+
+def defaultstrategies(delays):  # compare single target, group and batched group polling for every delay
+    strategies = []
+    for delay in delays:
+        strategies.append(Strategy("single %.2fs" % delay, delay, False, False, False))
+        strategies.append(Strategy("group %.2fs" % delay, delay, True, False, False))
+        strategies.append(Strategy("batched %.2fs" % delay, delay, True, True, False))
+        strategies.append(Strategy("batched vacancy %.2fs" % delay, delay, True, True, True))
+    return strategies
+
+
+def samplerstage(interval):  # sample the stacks of all other threads every interval seconds
+    me = threading.get_ident()
+    while not profilerstop.wait(interval):
+        names = {x.ident: x.name for x in threading.enumerate()}
+        samples = []
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread-%d" % ident))
+            samples.append(";".join(reversed(stack)))
+        with profilelock:
+            for stack in samples:
+                profilestacks[stack] = profilestacks.get(stack, 0) + 1
+
+
+def dumpprofile(*args):  # write the samples as folded stacks and a per function summary
+    with profilelock:
+        stacks = dict(profilestacks)
+    total = sum(stacks.values())
+    if total == 0:
+        return
+    selfcount = {}
+    totalcount = {}
+    for stack, n in stacks.items():
+        frames = stack.split(";")[1:]  # without the thread name
+        if frames:
+            selfcount[frames[-1]] = selfcount.get(frames[-1], 0) + n
+        for frame in set(frames):
+            totalcount[frame] = totalcount.get(frame, 0) + n
+    try:
+        with open(PROFILEPATH + ".folded", 'w', encoding="utf-8") as f:
+            for stack, n in sorted(stacks.items()):
+                f.write("%s %d\n" % (stack, n))
+        with open(PROFILEPATH + ".txt", 'w', encoding="utf-8") as f:
+            f.write("%d samples\n%8s %8s  %s\n" % (total, "total%", "self%", "function"))
+            for frame, n in sorted(totalcount.items(), key=lambda x: -x[1]):
+                f.write("%7.1f%% %7.1f%%  %s\n" % (100 * n / total, 100 * selfcount.get(frame, 0) / total, frame))
+        print("Profile of %d samples is saved to %s.folded and %s.txt" % (total, PROFILEPATH, PROFILEPATH))
+    except OSError:
+        print("Error: Unable to write profile")
+
+
+def startprofiler(interval):  # profile the whole run, dump on exit or on SIGUSR1
+    global profilerstop
+    import atexit
+    import signal
+    profilerstop = threading.Event()
+    threading.Thread(target=samplerstage, args=(interval,), name="sampler", daemon=True).start()
+    atexit.register(dumpprofile)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, dumpprofile)
+
+
+def parseargs():
+    import argparse
+    parser = argparse.ArgumentParser(description="SHU Course Selection Helper")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="report the import and initialization time of each startup phase")
+    parser.add_argument("--sync-catalog", action="store_true",
+                        help="crawl the course list into the local catalog %s and quit" % CATALOGPATH)
+    parser.add_argument("--campus", default="", help="only sync courses of this campus id")
+    parser.add_argument("--college", default="", help="only sync courses of this college id")
+    parser.add_argument("--time", default="", help="only sync courses of this time text")
+    parser.add_argument("--max-age", type=float, default=0,
+                        help="skip syncing if the same courses were synced within this many minutes")
+    parser.add_argument("--search-catalog", metavar="KEYWORD",
+                        help="search the local catalog by course id, course name, teacher id or name and quit")
+    parser.add_argument("--not-full", action="store_true", help="only list courses with vacancies when searching")
+    parser.add_argument("--history", metavar="CID,TID",
+                        help="show when seats of a section were released in the past and quit, no login required")
+    parser.add_argument("--profile", action="store_true",
+                        help="sample the stacks of all threads and write %s.folded and %s.txt on exit or SIGUSR1" % (
+                            PROFILEPATH, PROFILEPATH))
+    parser.add_argument("--profile-interval", type=float, default=0.01, help="sampling interval (sec) of --profile")
+    parser.add_argument("--simulate", action="store_true",
+                        help="compare polling strategies in simulated selection rounds and quit, no login required")
+    parser.add_argument("--rounds", type=int, default=1000, help="number of simulated rounds per strategy")
+    parser.add_argument("--delays", default="0.5,1.5,3", help="comma separated query delays (sec) to simulate")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the simulation")
+    scenario = Simscenario()
+    parser.add_argument("--sim-sections", type=int, default=scenario.sections,
+                        help="number of sections of the simulated course")
+    parser.add_argument("--sim-capacity", type=int, default=scenario.capacity, help="capacity of every section")
+    parser.add_argument("--sim-window", type=float, default=scenario.window, help="length (sec) of a simulated round")
+    parser.add_argument("--sim-release-rate", type=float, default=scenario.release_rate,
+                        help="seats released per minute per section")
+    parser.add_argument("--sim-competitors", type=int, default=scenario.competitors,
+                        help="number of competing students")
+    parser.add_argument("--sim-reaction", type=float, default=scenario.reaction,
+                        help="mean reaction time (sec) of a competitor to a released seat")
+    parser.add_argument("--sim-latency", type=float, default=scenario.latency,
+                        help="median round trip (sec) of a request")
+    parser.add_argument("--sim-error-rate", type=float, default=scenario.error_rate,
+                        help="probability that a request fails")
+    return parser.parse_args()
+
+
+def main():
+    global username, password, profile_startup
+    args = parseargs()
+    profile_startup = args.profile_startup
+    markphase("Module import")
+    if args.profile:
+        startprofiler(args.profile_interval)
+    if args.simulate:
+        scenario = Simscenario(sections=args.sim_sections, capacity=args.sim_capacity, window=args.sim_window,
+                               release_rate=args.sim_release_rate, competitors=args.sim_competitors,
+                               reaction=args.sim_reaction, latency=args.sim_latency, error_rate=args.sim_error_rate)
+        simulate(defaultstrategies([float(x) for x in args.delays.split(",")]), scenario, args.rounds, args.seed)
+        return
+    count = 0
+    while count < 6:
 
-            print("Please enter the info of courses, enter nothing to finish")
-            while True:
-                a = input("Enter the course  id of course %d :" % i)
-                if a == "":
-                    if i > 1:
-                        break
-                    else:
-                        print("You must enter at least 1 course")
-                        continue
-                if len(a) != 8:
-                    print("Invalid input, please enter again")
-                    continue
-                b = input("Enter the teacher id of course %d :" % i)
+        try:
+            print("SCourseHelper V" + VER)
+            print()
+            print("FREE, Open Source on https://github.com/hidacow/SHU-CourseHelper")
+            print()
+            print()
+            print("Reading Config...", end="")
+            readconfig()
+            markphase("Read config")
+            print()
+            if keep_logs == True:
+                logging.basicConfig(filename=LOGPATH, format=LOG_FORMAT, datefmt=DATE_FORMAT, level=logging_level)
+                print("Logging is ENABLED. Program logs can be found at %s\n" % LOGPATH)
+            else:
+                logging.disable(100)
+
+            logging.info("SCourseHelper V%s started." % VER)
+            markphase("Init logging")
+            if args.history is not None:
+                showhistory(*args.history.split(",")[:2])
+                return
+            if args.search_catalog is not None:
+                courses = searchcatalog(args.search_catalog, args.not_full)
+                for course in courses:
+                    print(str_courseinfo(course), course.timetext)
+                print("%d teaching class(es) found" % len(courses))
+                return
+            if username == "":
+                username = input("User:")
+            else:
+                print("User:%s" % username)
+            if password == "" and encryptedpassword == "":
+                password = getpass.getpass("Password:")
+            markphase("Wait for user input")
 
-                if b == "":
-                    if i > 1:
+            if encryptedpassword != "":
+                epwd = encryptedpassword
+            else:
+                epwd = encryptPass(password)
+                markphase("Encrypt password")
+            s = login(username, epwd)
+            markphase("Login and select term")
+            if args.sync_catalog:
+                syncCatalog(s, args.max_age, campus=args.campus, college=args.college, timetext=args.time)
+                return
+
+            precomputed = len(inputlist) > 0
+            if precomputed:  # while waiting is cheaper than after selection begins
+                tryprecomputeconflicts(s)
+                markphase("Precompute conflicts")
+
+            selecttime = isSelectTime(s)
+            markphase("Check selection time")
+            if profile_startup:
+                reportstartup()
+            if not selecttime:
+                i = 0
+                print("Not Selection Time...Wait %.2f sec..." % chk_select_time_delay)
+                logging.warning("Not Selection Time")
+                while True:
+                    print("Retry Times: " + str(i))
+                    time.sleep(chk_select_time_delay)
+                    i += 1
+                    if isSelectTime(s):
                         break
-                    else:
-                        print("Incomplete information, please enter again")
-                        continue
-                if len(b) != 4:
-                    print("Invalid input, please enter again")
-                    continue
-                c = input("Do you want to replace a course you have selected with this one?\n[Y/N(default)]:")
+
+            print("Selection Time OK", end="\n\n")
+            if len(inputlist) == 0:
+                i = 1
+                print("Enter the courses in the config is recommended. See README for more info\n")
+
+                print("Please enter the info of courses, enter nothing to finish")
                 while True:
-                    if c == "Y" or c == "y":
-                        d = input("Enter the course  id of the course to replace :")
-                        if d == "":
-                            print("Abort")
-                            c = "n"
-                            continue
-                        if len(d) != 8:
-                            print("Invalid input, please enter again")
+                    a = input("Enter the course  id of course %d :" % i)
+                    if a == "":
+                        if i > 1:
+                            break
+                        else:
+                            print("You must enter at least 1 course")
                             continue
-                        e = input("Enter the teacher id of the course to replace :")
-                        if e == "":
+                    if len(a) != 8:
+                        print("Invalid input, please enter again")
+                        continue
+                    b = input("Enter the teacher id of course %d :" % i)
+
+                    if b == "":
+                        if i > 1:
+                            break
+                        else:
                             print("Incomplete information, please enter again")
                             continue
-                        if len(e) != 4:
-                            print("Invalid input, please enter again")
-                            continue
-                        inputlist.append(Courseitem(a, b, d, e))
-                        break
-                    else:
-                        if c == "N" or c == "n" or c == "":
-                            inputlist.append(Courseitem(a, b, "null", "null"))
+                    tids = b.split("/")  # alternative sections in order of priority
+                    if not all(len(x) == 4 for x in tids):
+                        print("Invalid input, please enter again")
+                        continue
+                    b = tids[0]
+                    group = tuple(tids) if len(tids) > 1 else ()
+                    c = input("Do you want to replace a course you have selected with this one?\n[Y/N(default)]:")
+                    while True:
+                        if c == "Y" or c == "y":
+                            d = input("Enter the course  id of the course to replace :")
+                            if d == "":
+                                print("Abort")
+                                c = "n"
+                                continue
+                            if len(d) != 8:
+                                print("Invalid input, please enter again")
+                                continue
+                            e = input("Enter the teacher id of the course to replace :")
+                            if e == "":
+                                print("Incomplete information, please enter again")
+                                continue
+                            if len(e) != 4:
+                                print("Invalid input, please enter again")
+                                continue
+                            inputlist.append(Courseitem(a, b, d, e, group))
                             break
                         else:
-                            c = input("Please enter ""Y"" or ""N"" :")
-                i += 1
-
-        SubmitList = []
-        DropList = []
-        i = 0
-        send("开始了")
-        while True:
-            if i > 0:
-                if auto_cls:
-                    clear()
-                print()
-                print('#' * 50)
-                print()
-                print("Retry:%d" % i)
-                SubmitList.clear()
-                DropList.clear()
-
-            print("Checking %d course(s)" % len(inputlist), end="\n\n")
-            print("-------------------------")
-            for item in inputlist:
-                course = getCourseInfo(item.courseid, item.teacherid, s)
-                print(str_courseinfo(course), end="")
-                if canSelect(course):
-                    print("... can be selected!!")
-                    SubmitList.append(item)
-                    if item.replacecid != "null":
-                        DropList.append(item)
-                        SubmitList.append(Courseitem(item.replacecid, item.replacetid, "backup",
-                                                     "backup"))  # select it back in case of failure
-                else:
-                    print("")
-            print("-------------------------", end="\n\n")
-
-            if len(SubmitList) > 0:
-                printf("Trying to select %d course(s)..." % (len(SubmitList) - len(DropList)), end="\n\n")
-                logging.info("%d course(s) can be selected" % (len(SubmitList) - len(DropList)))
-                dropsuccess = 0
-                if len(DropList) > 0:  # Drop the replace courses first
-                    printf("Need to drop %d course(s)..." % len(DropList), end="")
-                    logging.info("%d course(s) need to be dropped first" % len(DropList))
-                    if returnCourse(DropList, s):
-                        printf("Success")
-                        dropsuccess = 1
-                    else:
-                        printf("Failed, continue anyway")
-                        logging.warning("Cannot to return some courses")
-                        dropsuccess = -1
-
-            print()
-            result = selectCourse(SubmitList, s)
-            for item in SubmitList:
-                rid = findcourseinlist(item.courseid, item.teacherid, result)  # find in result
-                selection = result[rid]
-                if item.replacecid != "null" and item.replacecid != "backup":  # Has backup
-                    rid2 = findcourseinlist(item.replacecid, item.replacetid, result)  # Find the result of backup selection
-                    # if selection is success and backupselection is not success: replacement successful, delete from task
-                    # if selection failed but backup selection is success: replacement not successful, continue loop
-                    # if selection and backup both failed: continue loop
-                    printf(str_selectionresult(selection))
-                    logging.info("Target  Course %s" % str_selectionresult(selection))
-                    if selection.isSuccess:
-                        if not result[rid2].isSuccess:  # Best situation
-                            printf("Previously selected course %s had been automatically returned" % str_coursebaseinfo(result[rid2]))
-                            logging.info("Previously selected course %s had been automatically returned" % str_coursebaseinfo(result[rid2]))
-                        else:  # Exceptional situation: User entered two courses that are not conflicting, TODO(maybe):return the unwanted course
-                            printf(str_selectionresult(result[rid2]))
-                            printf(
-                                "The two courses are not conflicting, both are selected, you might want to manually return one of them")
-                            logging.info("Backup Course %s" % str_selectionresult(result[rid2]))
-                        deletecoursefromlist(selection.courseid, selection.teacherid)  # remove from task due to success
-                    else:  # not selection.isSuccess
-                        printf(str_selectionresult(result[rid2]))
-                        logging.info("Backup Course %s" % str_selectionresult(result[rid2]))
-                        if result[rid2].isSuccess:
-                            printf("Course replacement failed, the course you previously selected had been selected back")
-                            # if target course selection failed with certain reason, discontinue
-                            if selection.isSuccess or any(x in selection.msg for x in _stop_condition2):
-                                deletecoursefromlist(selection.courseid, selection.teacherid)
-                                if "已选此课程" in selection.msg:
-                                    printnwarn("Please return the course %s manually, and add it again" % selection.coursename)
-                                if any(x in selection.msg for x in _stop_condition):
-                                    printnwarn(
-                                        "Please change courses conflicting with %s manually, and add it again" % selection.coursename)
-                                printnwarn(
-                                    "Due to unresolved conflicts in selecting the target course, the program will stop selecting this course")
-                            else:
-                                printf("The program will continue trying to replace the course")
-                        else:  # Exceptional or Unfortunate situation: Both courses are dropped
-                            if "无此教学班数据" in result[rid2].msg:
-                                printnwarn("Invalid Return Course Data")
-                                deletecoursefromlist(selection.courseid, selection.teacherid)
-                                # remove original item first
-                                inputlist.append(Courseitem(item.courseid, item.teacherid, "null", "null"))
-                                logging.info("Add %s,%s to list" % (item.courseid, item.teacherid))
-                                # add an item without replacement
+                            if c == "N" or c == "n" or c == "":
+                                inputlist.append(Courseitem(a, b, "null", "null", group))
+                                break
                             else:
-                                if any(x in selection.msg for x in _stop_condition2):
-                                    if dropsuccess == 1:  # drop success
-                                        printnwarn(
-                                            "Seems impossible to replace course, please check selection strategy and retry")
-                                        deletecoursefromlist(selection.courseid, selection.teacherid)  # discontinue
-                                    if dropsuccess == -1 and ("已选此课程" in result[rid2].msg) or any(x in result[rid2].msg for x in _stop_condition):
-                                        printnwarn("Seems unable to select the original course back, did you select it?")
-                                        deletecoursefromlist(selection.courseid, selection.teacherid)  # discontinue
-                                    else:
-                                        if dropsuccess == -1:
-                                            printf(
-                                                "It seems that the error relates to failure in returning courses, the program will retry")
-                                else:
-                                    printf(
-                                        "Unfortunately, failed to select both courses, trying to select either of the courses")
-                                    deletecoursefromlist(selection.courseid, selection.teacherid)
-                                    logging.warning("Cannot Select both course. Add %s,%s ; %s,%s to list" % (
-                                        item.courseid, item.teacherid, item.replacecid, item.replacetid))
-                                    # remove original item first
-                                    inputlist.append(Courseitem(item.courseid, item.teacherid, "null", "null"))
-                                    # add an item without replacement
-                                    inputlist.append(Courseitem(item.replacecid, item.replacetid, "null", "null"))
-                                    # add the original course to tasks
-                else:
-                    if item.replacecid != "backup":
-                        printf(str_selectionresult(selection))
-                        logging.info("Target  Course %s" % str_selectionresult(selection))
-                        if selection.isSuccess or any(x in selection.msg for x in _stop_condition2):
-                            deletecoursefromlist(selection.courseid, selection.teacherid)
-                            # success or need user actions, discontinue
-                            if "已选此课程" in selection.msg:
-                                printnwarn("Please return the course %s manually, and add it again" % selection.coursename)
-                            if any(x in selection.msg for x in _stop_condition):
-                                printnwarn(
-                                    "Please change courses conflicting with %s manually, and add it again" % selection.coursename)
-                            printf(
-                                "You may also edit the config to let the program automatically return conflicting courses")
-                    # else is backup, ok to skip
-                del result[rid]  # We don't need this result item anymore
-                print()
-
-                # Judge task progress
-                if len(inputlist) == 0:
-                    printf("Task done!")
-                    logging.info("All Task Done!")
-                    break
-            else:
-                print("No course can be selected...")
-
-            print("%d course(s) remaining...Wait %.2f sec..." % (len(inputlist), query_delay))
-            logging.debug("%d course(s) remaining" % len(inputlist))
-            i += 1
-            time.sleep(query_delay)
-        logging.info("Program terminated normally.")
-    except Exception as e:
-        ans = ""
-        for each in e.args:
-            if type(each) is str:
-                ans += each + '\n'
-        printf("报错了，但仍然在继续运行:" + ans)
-        time.sleep(60)
-        count += 1
-        if (count > 5):
-            printf("报错五次了，不运行了")
-            e = 2
+                                c = input("Please enter ""Y"" or ""N"" :")
+                    i += 1
+
+            for item in inputlist:  # point out alternative sections known by the local catalog
+                if not item.group:
+                    others = [c.teacherid for c in catalogsections(item.courseid) if c.teacherid != item.teacherid]
+                    if others:
+                        print("Course %s also has section(s) %s, enter %s,%s/%s to accept them as alternatives" % (
+                            item.courseid, ",".join(others), item.courseid, item.teacherid, "/".join(others)))
+
+            if not precomputed:  # courses were entered just now
+                tryprecomputeconflicts(s)
+            if len(inputlist) == 0:
+                printf("No course can be selected without conflicts")
+                return
+
+            runpipeline(s)
+            if replacementgaps:
+                logging.info("%d replacement(s), longest drop-to-select gap %.1f ms, dispatch %.2f ms" % (
+                    len(replacementgaps), max(x.exposed for x in replacementgaps) * 1000,
+                    max(x.dispatch for x in replacementgaps) * 1000))
+            logging.info("Program terminated normally.")
+            return
+        except Exception as e:
+            ans = ""
+            for each in e.args:
+                if type(each) is str:
+                    ans += each + '\n'
+            printf("报错了，但仍然在继续运行:" + ans)
+            time.sleep(60)
+            count += 1
+            if (count > 5):
+                printf("报错五次了，不运行了")
+                e = 2
+
+
+if __name__ == "__main__":
+    main()